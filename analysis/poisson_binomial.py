@@ -17,10 +17,37 @@ More details on Poisson binomial distribution https://en.wikipedia.org/wiki/Pois
 """
 
 import numpy as np
-from scipy.stats import norm
-from typing import Sequence, Tuple
+import numpy.typing as npt
+import scipy.fft
+from scipy.special import ndtr
+from scipy.stats import binom
+from typing import List, Sequence, Tuple
 from dataclasses import dataclass
 
+try:
+    import numba
+except ImportError:
+    # It is fine if Numba is not installed, then PGF is expanded with NumPy.
+    numba = None
+
+# compute_pmf expands PGF of each _LEAF_SIZE probabilities directly, and then
+# multiplies the leaf PGFs pairwise. Since the direct expansion drops
+# negligible tails, it takes O(n*sqrt(n)) operations and for up to a few
+# thousands probabilities it is as fast as the tree product.
+_LEAF_SIZE = 4096
+# Inputs of at most _MAX_SMALL_INPUT_SIZE probabilities are expanded directly
+# without truncation. For them truncation and the binomial specialization
+# cost more than they save.
+_MAX_SMALL_INPUT_SIZE = 128
+# During the direct expansion, after each _TRUNCATION_PERIOD linear factors,
+# and after each pairwise product, the tails of PGF coefficients with the
+# total probability below _TRUNCATED_TAIL_PROBABILITY are dropped.
+_TRUNCATION_PERIOD = 64
+_TRUNCATED_TAIL_PROBABILITY = 1e-18
+# Products with a polynomial of at most _MAX_DIRECT_CONVOLUTION_LENGTH
+# coefficients are computed directly, the others with FFT.
+_MAX_DIRECT_CONVOLUTION_LENGTH = 32
+
 
 @dataclass
 class PMF:
@@ -32,52 +59,315 @@ class PMF:
          distribution attains value i+start.
 
     """
+    # slots=True of dataclass requires Python 3.10, so slots are set manually.
+    __slots__ = ('start', 'probabilities')
     start: int
     probabilities: np.ndarray
 
 
-def compute_pmf(probabilities: Sequence[float]) -> np.ndarray:
-    """Computes probability mass function of Poisson binomial distribution."""
+def compute_pmf(probabilities: Sequence[float],
+                dtype: npt.DTypeLike = np.float64) -> PMF:
+    """Computes probability mass function of Poisson binomial distribution.
+
+    For more than _MAX_SMALL_INPUT_SIZE probabilities, the tails of
+    negligible probability are dropped, so the returned PMF can start from a
+    positive value and not cover all values up to len(probabilities). The
+    tails of total probability <10^(-18) are dropped after each block of the
+    direct expansion and after each product of the tree, and values below
+    FFT round-off error are zeroed. So the total dropped probability can
+    exceed 10^(-18), but it is of the order of the FFT round-off error.
+
+    Args:
+        probabilities: the success probabilities of the Bernoulli variables.
+        dtype: the floating point type of the returned probabilities. For large
+         inputs FFT is computed in this type too. np.float32 makes FFT faster,
+         but its precision is ~10^(-7), so small probabilities are not
+         accurate.
+    """
     # Compute coefficients of Probability Generating Function (PGF), which
     # equals to
     # PGF(x) = \product_{p\in ps}(1-p + p*x)
-    poisson_bin_probs = np.array([1])
+    # PGF is computed as a product of leaf PGFs, which are multiplied pairwise
+    # in a divide-and-conquer manner. With FFT multiplication this requires
+    # O(n log^2 n) operations and O(n) memory.
+    probabilities = np.asarray(probabilities, dtype=np.float64)
+    if len(probabilities) <= _MAX_SMALL_INPUT_SIZE:
+        coefficients = _pgf_expand(np.ones(1), probabilities)
+        return PMF(0, coefficients.astype(dtype, copy=False))
+    pmfs = _compute_leaf_pmfs(probabilities, dtype)
+    while len(pmfs) > 1:
+        next_pmfs = _convolve_pmf_pairs(list(zip(pmfs[0::2], pmfs[1::2])))
+        if len(pmfs) % 2 == 1:
+            next_pmfs.append(pmfs[-1])
+        pmfs = next_pmfs
+    return pmfs[0]
+
+
+def compute_pmf_batch(probabilities_batch: Sequence[Sequence[float]],
+                      dtype: npt.DTypeLike = np.float64) -> List[PMF]:
+    """Computes probability mass functions of Poisson binomial distributions.
+
+    Args:
+        probabilities_batch: the success probabilities of the Bernoulli
+         variables, one sequence per distribution.
+        dtype: the same as in compute_pmf.
+
+    Returns:
+        the result of compute_pmf for each element of probabilities_batch.
+    """
+    return [
+        compute_pmf(probabilities, dtype)
+        for probabilities in probabilities_batch
+    ]
+
+
+def _compute_leaf_pmfs(probabilities: np.ndarray,
+                       dtype: npt.DTypeLike) -> List[PMF]:
+    """Computes PMFs whose convolution is Poisson binomial distribution PMF.
+
+    Inputs with equal probabilities give one binomial PMF, otherwise PMFs of
+    groups of at most _LEAF_SIZE probabilities are computed directly.
+    """
+    if _is_binomial(probabilities):
+        pmfs = [_compute_binomial_pmf(probabilities)]
+    elif len(probabilities) <= _LEAF_SIZE:
+        pmfs = [_compute_pmf_directly(probabilities)]
+    else:
+        # The leaf PMFs are multiplied pairwise, sorting makes the paired
+        # PMFs similar, which keeps the magnitudes of the partial products
+        # well-scaled.
+        probabilities = np.sort(probabilities)
+        pmfs = [
+            _compute_pmf_directly(probabilities[i:i + _LEAF_SIZE])
+            for i in range(0, len(probabilities), _LEAF_SIZE)
+        ]
+    return [
+        _truncated_pmf(pmf.start, pmf.probabilities.astype(dtype, copy=False))
+        for pmf in pmfs
+    ]
+
+
+def _is_binomial(probabilities: np.ndarray) -> bool:
+    """Returns whether all probabilities are equal."""
+    return len(probabilities) > 1 and np.all(probabilities == probabilities[0])
+
+
+def _compute_binomial_pmf(probabilities: np.ndarray) -> PMF:
+    """Computes PMF of binomial distribution with the given probabilities."""
+    n = len(probabilities)
+    return PMF(0, binom.pmf(np.arange(n + 1), n, probabilities[0]))
+
+
+def _compute_pmf_directly(probabilities: np.ndarray) -> PMF:
+    """Computes PMF by multiplying PGF linear factors one by one.
+
+    The probability mass concentrates in O(sqrt(n)) coefficients around the
+    mean, so the negligible tails are periodically dropped to keep the
+    working array small.
+    """
+    start, coefficients = 0, np.ones(1)
+    for i in range(0, len(probabilities), _TRUNCATION_PERIOD):
+        if i > 0:
+            start, coefficients = _truncate_tails(start, coefficients)
+        coefficients = _pgf_expand(coefficients,
+                                   probabilities[i:i + _TRUNCATION_PERIOD])
+    return PMF(start, coefficients)
+
+
+def _convolve_pmf_pairs(pmf_pairs: List[Tuple[PMF, PMF]]) -> List[PMF]:
+    """Computes PMFs of the sums of pairs of independent random variables.
+
+    Products with a short polynomial are computed directly. The others are
+    computed with FFT: they are transformed with one batched real FFT of a
+    common length, the transforms are multiplied pointwise and the results are
+    transformed back. The pairs come from one level of the tree product, so
+    their lengths are similar and the common length wastes little.
+    """
+    result = [None] * len(pmf_pairs)
+    fft_indices = []
+    for i, (pmf1, pmf2) in enumerate(pmf_pairs):
+        if min(len(pmf1.probabilities), len(
+                pmf2.probabilities)) <= _MAX_DIRECT_CONVOLUTION_LENGTH:
+            result[i] = _truncated_pmf(
+                pmf1.start + pmf2.start,
+                np.convolve(pmf1.probabilities, pmf2.probabilities))
+        else:
+            fft_indices.append(i)
+    if not fft_indices:
+        return result
+    product_lens = [
+        len(pmf_pairs[i][0].probabilities) +
+        len(pmf_pairs[i][1].probabilities) - 1 for i in fft_indices
+    ]
+    fft_len = scipy.fft.next_fast_len(max(product_lens), real=True)
+    dtype = pmf_pairs[fft_indices[0]][0].probabilities.dtype
+    # factors[0, j] and factors[1, j] are the j-th pair.
+    factors = np.zeros((2, len(fft_indices), fft_len), dtype=dtype)
+    for j, i in enumerate(fft_indices):
+        for k, pmf in enumerate(pmf_pairs[i]):
+            factors[k, j, :len(pmf.probabilities)] = pmf.probabilities
+    with scipy.fft.set_workers(-1):
+        factors_fft = scipy.fft.rfft(factors, axis=-1)
+        products = scipy.fft.irfft(factors_fft[0] * factors_fft[1],
+                                   n=fft_len,
+                                   axis=-1)
+    # The round-off error of FFT products is about
+    # log2(fft_len) * eps * (the maximal value). Smaller values, including
+    # negative ones, are noise, they are zeroed so that the tails with them
+    # are truncated.
+    noise_level = np.log2(fft_len) * np.finfo(dtype).eps * products.max(
+        axis=-1, keepdims=True)
+    products[products < noise_level] = 0
+    for j, (i, product_len) in enumerate(zip(fft_indices, product_lens)):
+        start = pmf_pairs[i][0].start + pmf_pairs[i][1].start
+        pmf = _truncated_pmf(start, products[j, :product_len])
+        # Copy to release the memory of the whole products array.
+        pmf.probabilities = pmf.probabilities.copy()
+        result[i] = pmf
+    return result
+
+
+def _truncated_pmf(start: int, probabilities: np.ndarray) -> PMF:
+    """Returns PMF without the tails of negligible total probability."""
+    start, probabilities = _truncate_tails(start, probabilities)
+    return PMF(start, probabilities)
+
+
+def _truncate_tails(start: int,
+                    coefficients: np.ndarray) -> Tuple[int, np.ndarray]:
+    """Drops the tails of PMF with negligible total probability.
+
+    Returns:
+        the start and the coefficients of the truncated PMF.
+    """
+    max_tail_probability = _TRUNCATED_TAIL_PROBABILITY / 2
+    n_leading = np.searchsorted(np.cumsum(coefficients),
+                                max_tail_probability,
+                                side='right')
+    n_trailing = np.searchsorted(np.cumsum(coefficients[::-1]),
+                                 max_tail_probability,
+                                 side='right')
+    end = len(coefficients) - n_trailing
+    return start + n_leading, coefficients[n_leading:end]
+
+
+def _pgf_expand_in_place(coefficients: np.ndarray,
+                         probabilities: np.ndarray) -> np.ndarray:
+    """Multiplies PGF by linear factors one by one.
+
+    The coefficients are updated in place in a single buffer, so that no
+    temporary arrays are allocated.
+
+    Args:
+        coefficients: PGF coefficients before the multiplication.
+        probabilities: probabilities p of linear factors (1-p + p*x).
+
+    Returns:
+        PGF coefficients after the multiplication.
+    """
+    out = np.zeros(len(coefficients) + len(probabilities))
+    out[:len(coefficients)] = coefficients
+    k = len(coefficients)  # the number of coefficients computed so far.
     for p in probabilities:
+        q = 1 - p
+        # The loop goes downwards, so out[i - 1] is read before it is updated
+        # and iterations are independent. That allows the compiler to
+        # vectorize the loop with SIMD fused multiply-add instructions.
+        for i in range(k, 0, -1):
+            out[i] = out[i] * q + out[i - 1] * p
+        out[0] *= q
+        k += 1
+    return out
+
+
+def _pgf_expand_numpy(coefficients: np.ndarray,
+                      probabilities: np.ndarray) -> np.ndarray:
+    """Multiplies PGF by linear factors with NumPy.
+
+    See _pgf_expand_in_place for the arguments and the return value.
+    """
+    poisson_bin_probs = coefficients
+    # Arithmetic with Python floats is faster than with NumPy scalars.
+    for p in probabilities.tolist():
         next_poisson_bin_probs = np.zeros(len(poisson_bin_probs) + 1)
         next_poisson_bin_probs[:-1] = poisson_bin_probs * (1 - p)
         next_poisson_bin_probs[1:] += poisson_bin_probs * p
         poisson_bin_probs = next_poisson_bin_probs
-    return PMF(0, poisson_bin_probs)
+    return poisson_bin_probs
+
+
+if numba is not None:
+    # Only FMA contraction is enabled, the other fast math flags assume that
+    # the input has no NaNs and infinities.
+    _pgf_expand = numba.njit(cache=True,
+                             fastmath={'contract'})(_pgf_expand_in_place)
+else:
+    _pgf_expand = _pgf_expand_numpy
 
 
 def compute_exp_std_skewness(
         probabilities: Sequence[float]) -> Tuple[float, float, float]:
-    exp = np.sum(probabilities)
-    std = np.sqrt(np.sum([p * (1 - p) for p in probabilities]))
-    skewness = np.sum([p * (1 - p) * (1 - 2 * p) for p in probabilities
-                      ]) / std**3
+    p = np.asarray(probabilities, dtype=np.float64)
+    pq = p * (1 - p)
+    exp = p.sum()
+    std = np.sqrt(pq.sum())
+    # p*(1-p)*(1-2p) = pq - 2*p*pq, which reuses pq.
+    skewness = np.subtract(pq, 2 * p * pq).sum() / std**3
     return exp, std, skewness
 
 
-def compute_pmf_approximation(mean: float, sigma: float, skewness: float,
-                              n: int):
+def compute_pmf_approximation(mean: float,
+                              sigma: float,
+                              skewness: float,
+                              n: int,
+                              dtype: npt.DTypeLike = np.float64):
     """Computes approximate probability mass function of Poisson binomial distribution.
 
     The computation is based on paper chapter 3.3 (refined normal approximation)
     https://www.researchgate.net/publication/257017356_On_computing_the_distribution_function_for_the_Poisson_binomial_distribution
 
     The tails of probability <10^(-15) are dropped.
+
+    Args:
+        dtype: the floating point type in which the computations are performed
+         and the probabilities are returned. np.float32 halves the memory
+         traffic, but its precision is ~10^(-7), so small probabilities are
+         not accurate.
     """
-    if sigma == 0:
-        return PMF(int(round(mean)), np.array([1]))
-    G = lambda x: (norm.cdf(x) + skewness * (1 - x * x) * norm.pdf(x) / 6)
+    if sigma < 1e-12:
+        # The distribution is concentrated in one point (sigma can be slightly
+        # above 0 because of rounding errors).
+        return PMF(int(round(mean)), np.array([1], dtype=dtype))
     # n can be large. Assuming that the output distribution is close to the
     # normal, for all i further than 8*sigma contributes less than 10^(-15).
     # So compute probabilities for (mean-8*sigma, mean+8*sigma).
     start = max(0, int(np.floor(mean - 8 * sigma)))
     end = min(n, int(np.round(mean + 8 * sigma)))
 
-    xs = np.arange(start - 1, end + 1)
-    cdf_values = G((xs + 0.5 - mean) / sigma)
-    cdf_values = np.clip(cdf_values, 0, 1)
-    return PMF(start, np.diff(cdf_values))
+    # Evaluate CDF at points x = (i + 0.5 - mean) / sigma for i in
+    # [start-1, end].
+    z = np.arange(end - start + 2, dtype=dtype)
+    z += start - 0.5 - mean
+    z /= sigma
+    cdf_values = _refined_normal_cdf(z, skewness)
+    np.clip(cdf_values, 0, 1, out=cdf_values)
+    # The buffer of z is not needed anymore, reuse it for the output.
+    probabilities = z[:-1]
+    np.subtract(cdf_values[1:], cdf_values[:-1], out=probabilities)
+    return PMF(start, probabilities)
+
+
+def _refined_normal_cdf(x: np.ndarray, skewness: float) -> np.ndarray:
+    """Computes the refined normal approximation of CDF.
+
+    G(x) = Phi(x) + skewness * (1 - x^2) * phi(x) / 6, where Phi and phi are
+    CDF and pdf of the standard normal distribution.
+    """
+    x_squared = np.square(x)
+    # The correction term is computed in place in the temporary buffers.
+    correction = np.exp(-0.5 * x_squared)
+    correction *= skewness / (6 * np.sqrt(2 * np.pi))
+    np.subtract(1, x_squared, out=x_squared)
+    correction *= x_squared
+    correction += ndtr(x)
+    return correction
@@ -15,11 +15,20 @@
 
 from absl.testing import absltest
 from absl.testing import parameterized
+from unittest import mock
 
 import numpy as np
 from analysis import poisson_binomial
 
 
+def _dense_probabilities(pmf: poisson_binomial.PMF, size: int) -> np.ndarray:
+    """Returns probabilities of pmf for values 0, .., size-1."""
+    probabilities = np.zeros(size)
+    end = pmf.start + len(pmf.probabilities)
+    probabilities[pmf.start:end] = pmf.probabilities
+    return probabilities
+
+
 class PoissonBinomialTest(parameterized.TestCase):
 
     @parameterized.parameters(
@@ -32,7 +41,165 @@ class PoissonBinomialTest(parameterized.TestCase):
         ]))
     def test_compute_pmf(self, probabilities, expected_pmf):
         pmf = poisson_binomial.compute_pmf(probabilities)
-        self.assertSequenceAlmostEqual(expected_pmf, pmf.probabilities)
+        self.assertSequenceAlmostEqual(
+            expected_pmf, _dense_probabilities(pmf, len(expected_pmf)))
+
+    def test_compute_pmf_many_probabilities(self):
+        probabilities = np.random.default_rng(0).uniform(size=5000)
+        # Expected PMF is computed by sequential multiplication of the PGF
+        # linear factors.
+        expected_pmf = np.array([1.0])
+        for p in probabilities:
+            expected_pmf = np.convolve(expected_pmf, [1 - p, p])
+
+        pmf = poisson_binomial.compute_pmf(probabilities)
+
+        end = pmf.start + len(pmf.probabilities)
+        self.assertSequenceAlmostEqual(expected_pmf[pmf.start:end],
+                                       pmf.probabilities,
+                                       delta=1e-12)
+        self.assertLess(1 - np.sum(pmf.probabilities), 1e-12)
+
+    @parameterized.parameters(poisson_binomial._pgf_expand_in_place,
+                              poisson_binomial._pgf_expand_numpy)
+    def test_compute_pmf_with_pgf_expand_implementation(self, pgf_expand):
+        rng = np.random.default_rng(0)
+        probabilities_list = [[0.1, 0.2, 0.3],
+                              rng.uniform(size=100),
+                              rng.uniform(size=300)]
+        for probabilities in probabilities_list:
+            expected_pmf = np.array([1.0])
+            for p in probabilities:
+                expected_pmf = np.convolve(expected_pmf, [1 - p, p])
+
+            with mock.patch.object(poisson_binomial, '_pgf_expand', pgf_expand):
+                pmf = poisson_binomial.compute_pmf(probabilities)
+
+            self.assertSequenceAlmostEqual(
+                expected_pmf, _dense_probabilities(pmf, len(expected_pmf)))
+
+    @parameterized.parameters(0, 0.3, 1)
+    def test_compute_pmf_equal_probabilities(self, p):
+        probabilities = np.full(200, p)
+
+        pmf = poisson_binomial.compute_pmf(probabilities)
+
+        self.assertSequenceAlmostEqual(
+            poisson_binomial._pgf_expand_numpy(np.ones(1), probabilities),
+            _dense_probabilities(pmf,
+                                 len(probabilities) + 1))
+
+    @parameterized.parameters(np.float32, np.float64)
+    def test_compute_pmf_dtype(self, dtype):
+        probabilities = np.random.default_rng(0).uniform(size=5000)
+        expected_pmf = poisson_binomial.compute_pmf(probabilities)
+
+        pmf = poisson_binomial.compute_pmf(probabilities, dtype=dtype)
+
+        self.assertEqual(dtype, pmf.probabilities.dtype)
+        size = len(probabilities) + 1
+        self.assertSequenceAlmostEqual(_dense_probabilities(expected_pmf, size),
+                                       _dense_probabilities(pmf, size),
+                                       delta=1e-5)
+
+    def test_compute_pmf_batch(self):
+        rng = np.random.default_rng(0)
+        probabilities_batch = [
+            rng.uniform(size=1000), [], [0.1, 0.2, 0.3], [0.5] * 600,
+            rng.uniform(size=700),
+            rng.uniform(size=5000)
+        ]
+
+        pmfs = poisson_binomial.compute_pmf_batch(probabilities_batch)
+
+        self.assertLen(pmfs, len(probabilities_batch))
+        for probabilities, pmf in zip(probabilities_batch, pmfs):
+            expected_pmf = poisson_binomial.compute_pmf(probabilities)
+            size = len(probabilities) + 1
+            self.assertSequenceAlmostEqual(_dense_probabilities(
+                expected_pmf, size),
+                                           _dense_probabilities(pmf, size),
+                                           delta=1e-12)
+
+    @parameterized.parameters(([0] * 100 + [1] * 100, 100, [1]),
+                              ([1] * 200, 200, [1]),
+                              ([0.5] + [1] * 199, 199, [0.5, 0.5]))
+    def test_compute_pmf_drops_zero_tails(self, probabilities, expected_start,
+                                          expected_probabilities):
+        pmf = poisson_binomial.compute_pmf(probabilities)
+
+        self.assertEqual(expected_start, pmf.start)
+        self.assertSequenceAlmostEqual(expected_probabilities,
+                                       pmf.probabilities)
+
+    def test_compute_pmf_truncates_tails(self):
+        probabilities = np.random.default_rng(0).uniform(size=500)
+        expected_pmf = np.array([1.0])
+        for p in probabilities:
+            expected_pmf = np.convolve(expected_pmf, [1 - p, p])
+
+        pmf = poisson_binomial.compute_pmf(probabilities)
+
+        self.assertGreater(pmf.start, 0)
+        self.assertLess(len(pmf.probabilities), len(expected_pmf))
+        end = pmf.start + len(pmf.probabilities)
+        self.assertSequenceAlmostEqual(expected_pmf[pmf.start:end],
+                                       pmf.probabilities,
+                                       delta=1e-15)
+        self.assertLess(1 - np.sum(pmf.probabilities), 1e-15)
+
+    def test_convolve_pmf_pairs(self):
+        rng = np.random.default_rng(0)
+        # The first pair is convolved directly, the others with FFT.
+        starts_and_sizes = [(0, 5), (3, 100), (1, 300), (2, 200), (4, 40),
+                            (0, 1000)]
+        pmfs = [
+            poisson_binomial.PMF(start, rng.dirichlet(np.ones(size)))
+            for start, size in starts_and_sizes
+        ]
+        pmf_pairs = list(zip(pmfs[0::2], pmfs[1::2]))
+
+        result = poisson_binomial._convolve_pmf_pairs(pmf_pairs)
+
+        self.assertLen(result, len(pmf_pairs))
+        for (pmf1, pmf2), pmf in zip(pmf_pairs, result):
+            expected_pmf = poisson_binomial.PMF(
+                pmf1.start + pmf2.start,
+                np.convolve(pmf1.probabilities, pmf2.probabilities))
+            size = expected_pmf.start + len(expected_pmf.probabilities)
+            expected = _dense_probabilities(expected_pmf, size)
+            actual = _dense_probabilities(pmf, size)
+            self.assertSequenceAlmostEqual(expected, actual, delta=1e-15)
+
+    def test_compute_pmf_truncates_fft_product_tails(self):
+        probabilities = np.random.default_rng(0).uniform(size=20000)
+        sigma = np.sqrt(np.sum(probabilities * (1 - probabilities)))
+
+        pmf = poisson_binomial.compute_pmf(probabilities)
+
+        # Values further than ~9 sigma from the mean are below FFT round-off
+        # error.
+        self.assertLess(len(pmf.probabilities), 20 * sigma)
+        self.assertLess(abs(1 - np.sum(pmf.probabilities)), 1e-14)
+
+    def test_truncate_tails(self):
+        coefficients = np.array([1e-20, 1e-19, 0.5, 0.5 - 2e-19, 1e-20])
+
+        start, truncated = poisson_binomial._truncate_tails(3, coefficients)
+
+        self.assertEqual(5, start)
+        self.assertSequenceEqual([0.5, 0.5 - 2e-19], list(truncated))
+
+    @parameterized.parameters(poisson_binomial._pgf_expand_in_place,
+                              poisson_binomial._pgf_expand_numpy)
+    def test_pgf_expand(self, pgf_expand):
+        coefficients = np.array([0.9, 0.1])
+        probabilities = np.array([0.2, 0.3])
+
+        pgf_coefficients = pgf_expand(coefficients, probabilities)
+
+        self.assertSequenceAlmostEqual([0.504, 0.398, 0.092, 0.006],
+                                       pgf_coefficients)
 
     @parameterized.parameters(
         ([0, 0.5], [0.5, 0.5, 0]),
@@ -60,6 +227,46 @@ class PoissonBinomialTest(parameterized.TestCase):
                                        approximate_probabilities,
                                        delta=delta)
 
+    @parameterized.parameters(0, 1e-300, 1e-13)
+    def test_compute_pmf_approximation_zero_sigma(self, sigma):
+        pmf = poisson_binomial.compute_pmf_approximation(mean=5.0000001,
+                                                         sigma=sigma,
+                                                         skewness=0,
+                                                         n=10)
+
+        self.assertEqual(5, pmf.start)
+        self.assertSequenceEqual([1], list(pmf.probabilities))
+
+    def test_refined_normal_cdf(self):
+        x = np.array([-1.0, 0.0, 2.0])
+
+        result = poisson_binomial._refined_normal_cdf(x, skewness=0.6)
+
+        self.assertSequenceEqual([-1.0, 0.0, 2.0], list(x))
+        self.assertSequenceAlmostEqual(
+            [0.158655, 0.5 + 0.1 * 0.398942, 0.977250 - 0.3 * 0.053991],
+            result,
+            places=5)
+
+    def test_compute_pmf_approximation_float32(self):
+        probabilities = np.linspace(0.1, 0.9, num=50)
+        mean, std, skewness = poisson_binomial.compute_exp_std_skewness(
+            probabilities)
+
+        pmf64 = poisson_binomial.compute_pmf_approximation(
+            mean, std, skewness, len(probabilities))
+        pmf32 = poisson_binomial.compute_pmf_approximation(mean,
+                                                           std,
+                                                           skewness,
+                                                           len(probabilities),
+                                                           dtype=np.float32)
+
+        self.assertEqual(np.float32, pmf32.probabilities.dtype)
+        self.assertEqual(pmf64.start, pmf32.start)
+        self.assertSequenceAlmostEqual(pmf64.probabilities,
+                                       pmf32.probabilities,
+                                       delta=1e-6)
+
 
 if __name__ == '__main__':
     absltest.main()